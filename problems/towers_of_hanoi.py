@@ -3,7 +3,7 @@ import time
 import numpy as np
 from matplotlib import pyplot as plt
 from rl.env import Domain
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from copy import deepcopy
 from pathlib import Path
 
@@ -40,8 +40,15 @@ class State:
     State captures a state of the problem an ordered list of pegs.
     """
     pegs: list[Peg]
+    # cached encoding/key, computed on first use; pegs are never mutated once a
+    # state has been created, so the caches cannot go stale
+    _vector: np.ndarray = field(default=None, repr=False, compare=False)
+    _key: tuple = field(default=None, repr=False, compare=False)
 
     def vector(self):
+        if self._vector is not None:
+            return self._vector
+
         total_disks = sum([len(peg.disks) for peg in self.pegs])
         total_pegs = len(self.pegs)
 
@@ -59,8 +66,14 @@ class State:
                 ohe_disk_pos = size * total_pegs
                 # encode peg placement
                 ohe[ohe_disk_pos + curr_peg_i] = 1
+        self._vector = ohe
         return ohe
 
+    def key(self):
+        if self._key is None:
+            self._key = tuple(self.vector())
+        return self._key
+
 
 @dataclass
 class Action:
@@ -115,7 +128,8 @@ def successor(state: State, action: Action):
     Generate successor of state through application of action. Assumes action is
     a legal one.
     """
-    state = deepcopy(state)
+    # copy only the pegs so the successor starts with empty encoding caches
+    state = State(pegs=deepcopy(state.pegs))
     # pop front, mutating it in the process
     poppedDisk = state.pegs[action.popFrom].disks.pop(0)
 
@@ -151,6 +165,11 @@ class TowersOfHanoi(Domain):
         self.state_counts = []
         self.avg_state_count = []
 
+        # transitions are deterministic, so the successor state, its encoding and
+        # its legal actions are cached per (state, action) pair
+        self.current_state_key = None
+        self.successor_cache = {}
+
     def get_current_state(self):
         return self.states[-1].vector(), legal_actions(self.states[-1])
 
@@ -170,15 +189,26 @@ class TowersOfHanoi(Domain):
         pegs = [firstPeg] + restPegs
         self.states = [State(pegs=pegs)]
 
-        return self.get_current_state()
+        state, actions = self.get_current_state()
+        self.current_state_key = self.states[-1].key()
+        return state, actions
 
     def get_child_state(self, action):
-        self.states.append(
-            successor(self.states[-1], action)
-        )
+        cache_key = (self.current_state_key, action)
+        cached = self.successor_cache.get(cache_key)
+        if cached is None:
+            successor_state = successor(self.states[-1], action)
+            # successor states are never mutated, so the cached state object, its
+            # encoding and its actions can be handed out again on later visits
+            cached = (successor_state, successor_state.vector(), successor_state.key(), legal_actions(successor_state))
+            self.successor_cache[cache_key] = cached
+
+        successor_state, state, state_key, actions = cached
+        self.states.append(successor_state)
+        self.current_state_key = state_key
 
         reward = self.calculate_reward(self.states[-2], self.states[-1])
-        return *self.get_current_state(), reward
+        return state, actions, reward
 
     def calculate_reward(self, state_from, state_to):
         """
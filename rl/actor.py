@@ -1,73 +1,226 @@
-import math
+import random
+
 import numpy as np
-from matplotlib import pyplot as plt
 
-from rl.utils import DefaultValueTable
+from rl.utils import apply_td_update_2d
 
 
 class TableBasedActor:
     # contains policy, which computes a score expressing how desirable an action is in a given state
 
-    def __init__(self, learning_rate, epsilon):
-        # maps state-action pairs to desirability value
-        self.policy = DefaultValueTable(lambda: 0)
-        self.eligibilities = DefaultValueTable(lambda: 0)
+    __slots__ = (
+        'state_ids', 'action_ids', 'state_actions', 'state_cols', 'policy', 'eligibilities',
+        'active_rows', 'active_cols', 'num_active', 'learning_rate', 'epsilon',
+        'trace_cutoff', 'proposed_random_action'
+    )
+
+    def __init__(self, learning_rate, epsilon, state_ids=None, trace_cutoff=1e-8):
+        # maps states to row ids and actions to column ids of the policy/eligibility
+        # matrices; the state table can be shared with the critic so that each state
+        # is only interned once
+        self.state_ids = {} if state_ids is None else state_ids
+        self.action_ids = {}
+        # columns of the legal actions per state row, cached on first visit
+        self.state_actions = {}
+        # every column holding a policy value per state row, regardless of whether
+        # the state was visited or only loaded/merged from another table; this is
+        # what export_policy walks, so snapshots cover loaded states as well
+        self.state_cols = {}
+        self.policy = np.zeros((1024, 8))
+        self.eligibilities = np.zeros((1024, 8))
+        # preallocated buffers holding the row/column ids of the state-action pairs
+        # with a nonzero eligibility trace, filled up to num_active
+        self.active_rows = np.empty(1024, dtype=np.int32)
+        self.active_cols = np.empty(1024, dtype=np.int32)
+        self.num_active = 0
         self.learning_rate = learning_rate
         self.epsilon = epsilon
+        # traces that decay below this threshold are zeroed and no longer updated
+        self.trace_cutoff = trace_cutoff
+        # whether the most recent call to propose_action took the exploratory branch
+        self.proposed_random_action = False
+
+    def _action_id(self, action):
+        """
+        Interns the given action and returns its column id, widening the policy
+        and eligibility matrices whenever a new action does not fit anymore.
+        """
+        action_id = self.action_ids.get(action)
+        if action_id is None:
+            action_id = len(self.action_ids)
+            self.action_ids[action] = action_id
+            if action_id >= self.policy.shape[1]:
+                self.policy = np.concatenate((self.policy, np.zeros_like(self.policy)), axis=1)
+                self.eligibilities = np.concatenate((self.eligibilities, np.zeros_like(self.eligibilities)), axis=1)
+        return action_id
+
+    def intern_state(self, state):
+        """
+        Interns the given state and returns its integer id
+
+        :param state: state object to intern
+        :return: integer id of the state
+        """
+        state_key = tuple(state)
+        state_id = self.state_ids.get(state_key)
+        if state_id is None:
+            state_id = len(self.state_ids)
+            self.state_ids[state_key] = state_id
+        return state_id
+
+    def _ensure_rows(self, state_id):
+        """
+        Grows the policy and eligibility matrices until they cover the given row id
+        """
+        while state_id >= self.policy.shape[0]:
+            self.policy = np.concatenate((self.policy, np.zeros_like(self.policy)), axis=0)
+            self.eligibilities = np.concatenate((self.eligibilities, np.zeros_like(self.eligibilities)), axis=0)
+
+    def add_state(self, state_id, actions):
+        """
+        Registers the legal actions of an interned state and returns its row id,
+        growing the policy and eligibility matrices as needed.
+
+        :param state_id: integer id of an interned state
+        :param actions: actions that can be performed in the given state
+        :return: integer row id of the state
+        """
+        if state_id not in self.state_actions:
+            self._ensure_rows(state_id)
+            # the domains generate the legal actions of a state in a fixed order, so the
+            # cached columns stay aligned with the action lists passed to propose_action
+            cols = np.array([self._action_id(action) for action in actions], dtype=np.int64)
+            self.state_actions[state_id] = cols
+            self.state_cols.setdefault(state_id, set()).update(cols.tolist())
+        return state_id
+
+    def action_id(self, action):
+        """
+        Returns the column id of an already interned action
+        """
+        return self.action_ids[action]
 
     def reset(self):
         """
         Resets the eligibility for every state-action pair to 0
         """
-        for sa_id in self.eligibilities.keys():
-            self.eligibilities[sa_id] = 0
+        self.reset_eligibilities()
 
-    def increase_eligibility(self, state, action):
-        state_id = hash(tuple(state))
-        self.eligibilities[(state_id, action)] = 1
+    def reset_eligibilities(self):
+        """
+        Resets the eligibility for every state-action pair to 0. Only the active
+        traces can be nonzero, so zeroing those suffices
+        """
+        if self.num_active == 0:
+            return
+        self.eligibilities[self.active_rows[:self.num_active], self.active_cols[:self.num_active]] = 0
+        self.num_active = 0
+
+    def increase_eligibility(self, state_id, action_id):
+        """
+        Sets the eligibility of the visited state-action pair to 1 following the
+        replacing-trace rule, i.e. the trace is overwritten rather than accumulated
+        on revisits
+        """
+        if self.eligibilities[state_id, action_id] == 0:
+            if self.num_active == self.active_rows.shape[0]:
+                self.active_rows = np.concatenate((self.active_rows, np.empty_like(self.active_rows)))
+                self.active_cols = np.concatenate((self.active_cols, np.empty_like(self.active_cols)))
+            self.active_rows[self.num_active] = state_id
+            self.active_cols[self.num_active] = action_id
+            self.num_active += 1
+        self.eligibilities[state_id, action_id] = 1
 
-    def propose_action(self, state, actions):
+    def propose_action(self, state, actions, state_id=None):
         """
         proposes an action in a given state based on the desirability determined by the policy
         :param state: state object for which an action should be selected
         :param actions: actions that can be performed in the given state
-        :param
+        :param state_id: row id of an already interned state, interned on the fly when omitted
         :return: an action
         """
         if len(actions) == 0:
             return None
-        state_id = hash(tuple(state))
-        if np.random.choice(np.array([0, 1]), p=[1 - self.epsilon, self.epsilon]) == 1:
-            return np.random.choice(np.array(actions))
-        best_action = None
-        max_value = -math.inf
-        for action in actions:
-            state_value = self.policy[(state_id, action)]
-            if state_value > max_value:
-                best_action = action
-                max_value = state_value
-        return best_action
-
-    def update_policy(self, episode, td_error):
-        """
-        Updates the policy using the td error computed by the critic
-
-        :param episode:
-        :param td_error: temporal difference error computed by the critic
+        if state_id is None:
+            state_id = self.add_state(self.intern_state(state), actions)
+        if random.random() < self.epsilon:
+            self.proposed_random_action = True
+            return actions[random.randrange(len(actions))]
+        self.proposed_random_action = False
+        return actions[int(np.argmax(self.policy[state_id, self.state_actions[state_id]]))]
+
+    def export_policy(self):
+        """
+        Exports the policy as a {(state key, action): value} table, e.g. for handing
+        a snapshot to rollout workers
+
+        :return: dict mapping (state key, action) pairs to their policy value
         """
-        for state, action in episode:
-            state_id = hash(tuple(state))
-            self.policy[(state_id, action)] += self.learning_rate * td_error * self.eligibilities[(state_id, action)]
+        actions = [None] * len(self.action_ids)
+        for action, col in self.action_ids.items():
+            actions[col] = action
+        table = {}
+        for state_key, state_id in self.state_ids.items():
+            action_cols = self.state_cols.get(state_id)
+            if action_cols is None:
+                continue
+            for col in action_cols:
+                table[(state_key, actions[col])] = self.policy[state_id, col]
+        return table
 
-    def update_eligibilities(self, episode, discount_rate, decay_factor):
+    def load_policy(self, table):
         """
-        Updates the eligibilities for the given state-action pair based on the discount rate and
-        decay factor.
+        Overwrites policy entries with the values of the given table. The legal-action
+        columns of the loaded states are registered lazily once the states are visited
 
-        :param episode:
-        :param discount_rate: discount rate
-        :param decay_factor: decay factor of eligibility
+        :param table: dict mapping (state key, action) pairs to their policy value
+        """
+        for (state_key, action), value in table.items():
+            state_id = self.intern_state(state_key)
+            self._ensure_rows(state_id)
+            col = self._action_id(action)
+            self.state_cols.setdefault(state_id, set()).add(col)
+            self.policy[state_id, col] = value
+
+    def merge_policy(self, table, snapshot):
+        """
+        Applies the difference between the given policy table and the snapshot it was
+        derived from onto the local policy
+
+        :param table: policy table returned by a rollout worker
+        :param snapshot: the policy table the worker started from
+        """
+        for (state_key, action), value in table.items():
+            state_id = self.intern_state(state_key)
+            self._ensure_rows(state_id)
+            col = self._action_id(action)
+            # record the column even for unchanged entries, so the next exported
+            # snapshot covers every pair the workers already know about
+            self.state_cols.setdefault(state_id, set()).add(col)
+            delta = value - snapshot.get((state_key, action), 0)
+            if delta != 0:
+                self.policy[state_id, col] += delta
+
+    def update(self, td_error, trace_decay):
+        """
+        Updates the policy for the state-action pairs with an active eligibility trace
+        using the td error computed by the critic, and decays their traces, in one
+        fused pass. Traces that decay below trace_cutoff are dropped from the active
+        set, so the per-step cost stays bounded regardless of episode length
+
+        :param td_error: temporal difference error computed by the critic
+        :param trace_decay: product of the discount rate and the eligibility decay factor
         """
-        for state, action in episode:
-            state_id = hash(tuple(state))
-            self.eligibilities[(state_id, action)] *= discount_rate * decay_factor
+        if self.num_active == 0:
+            return
+        self.num_active = apply_td_update_2d(
+            self.policy,
+            self.eligibilities,
+            self.active_rows[:self.num_active],
+            self.active_cols[:self.num_active],
+            # the NN critic returns the td error as a tensor, so coerce the
+            # coefficient to a plain float for the kernel
+            float(self.learning_rate * td_error),
+            trace_decay,
+            self.trace_cutoff
+        )
@@ -1,3 +1,6 @@
+import random
+from concurrent.futures import ProcessPoolExecutor
+
 import numpy as np
 from tqdm import tqdm
 
@@ -7,7 +10,15 @@ from rl.env import Domain
 
 
 class ACM:
+
+    __slots__ = (
+        'config', 'max_episodes', 'steps', 'critic_type', 'critic_nn_dims', 'actor_lr',
+        'critic_lr', 'decay_factor', 'discount_rate', 'epsilon', 'epsilon_decay',
+        'visualise', 'workers', 'trace_cutoff', 'state_ids', 'actor', 'critic'
+    )
+
     def __init__(self, config):
+        self.config = config
         self.max_episodes = config["episodes"]
         self.steps = config["steps"]
         self.critic_type = config["critic_type"]
@@ -19,26 +30,47 @@ class ACM:
         self.epsilon = config["epsilon"]
         self.epsilon_decay = config["epsilon_decay"]
         self.visualise = config["visualise"]
+        # number of processes collecting episodes in parallel
+        self.workers = config.get("workers", 1)
+        # eligibility traces below this threshold are dropped instead of updated
+        self.trace_cutoff = config.get("trace_cutoff", 1e-8)
+
+        # state-id table shared by the actor and the table-based critic, so every
+        # state is interned once and maps to the same integer id in both
+        self.state_ids = {}
 
         self.actor = TableBasedActor(
             learning_rate=self.actor_lr,
-            epsilon=self.epsilon
+            epsilon=self.epsilon,
+            state_ids=self.state_ids,
+            trace_cutoff=self.trace_cutoff
         )
         if self.critic_type == "table":
-            self.critic = TableBasedCritic(self.critic_lr)
+            self.critic = TableBasedCritic(self.critic_lr, state_ids=self.state_ids, trace_cutoff=self.trace_cutoff)
         else:
             self.critic = NNBasedCritic(self.critic_lr, self.critic_nn_dims)
 
-    def fit(self, domain: Domain):
+    def fit(self, domain: Domain, show_progress=True):
         """
         learns the target policy for a given domain
 
         :param domain: domain object for which the target policy should be learned
+        :param show_progress: whether to display the progressbar
         """
+        if self.workers > 1:
+            if not isinstance(self.critic, TableBasedCritic):
+                raise ValueError("parallel fit is only supported with the table-based critic")
+            self._fit_parallel(domain)
+            return
+
         # used for the progressbar only
-        steps_per_episode = []
+        total_steps = 0
+        min_steps = self.steps
+
+        # loop-invariant decay of the eligibility traces per step
+        trace_decay = self.discount_rate * self.decay_factor
 
-        progress = tqdm(range(self.max_episodes), desc="Episode", colour="green")
+        progress = tqdm(range(self.max_episodes), desc="Episode", colour="green", disable=not show_progress)
         for episode_count in progress:
 
             # reset actor and critic
@@ -47,47 +79,55 @@ class ACM:
 
             # get initial state and action
             current_state, actions = domain.get_init_state()
+            current_state_id = self.actor.intern_state(current_state)
+            self.critic.add_state(current_state_id)
+            self.actor.add_state(current_state_id, actions)
             if episode_count == 0:
-                current_action = np.random.choice(np.array(actions))
+                current_action = actions[random.randrange(len(actions))]
             else:
-                current_action = self.actor.propose_action(current_state, actions)
-
-            # initialise an empty episode
-            episode = []
+                current_action = self.actor.propose_action(current_state, actions, state_id=current_state_id)
 
             step = 0
             while step < self.steps and not domain.is_current_state_terminal():
+                current_action_col = self.actor.action_id(current_action)
                 step += 1
 
-                # append the current state-action pair to the current episode and initialise required values
-                # in the actor and critic
-                episode.append((current_state, current_action))
-
                 # obtain a successor state and the reinforcement from moving to that state from the domain
                 successor_state, actions, reinforcement = domain.get_child_state(current_action)
+                successor_state_id = self.actor.intern_state(successor_state)
+                self.critic.add_state(successor_state_id)
+                self.actor.add_state(successor_state_id, actions)
 
                 # determine the best action from the successor based on the current policy
-                successor_action = self.actor.propose_action(state=successor_state, actions=actions)
+                successor_action = self.actor.propose_action(state=successor_state, actions=actions, state_id=successor_state_id)
+
+                # Watkins-style cut-off: an exploratory action invalidates the accumulated
+                # traces, so drop them instead of propagating the td error backwards
+                if self.actor.proposed_random_action:
+                    self.actor.reset_eligibilities()
+                    self.critic.reset_eligibilities()
 
                 # increase the eligibility of the current state
-                self.actor.increase_eligibility(current_state, current_action)
+                self.actor.increase_eligibility(current_state_id, current_action_col)
 
                 # compute the td error using the current and the successor state
                 td_error = self.critic.compute_td_error(
                     state=current_state,
                     successor_state=successor_state,
                     reinforcement=reinforcement,
-                    discount_rate=self.discount_rate
+                    discount_rate=self.discount_rate,
+                    state_id=current_state_id,
+                    successor_id=successor_state_id
                 )
-                self.critic.increase_eligibility(current_state)
+                self.critic.increase_eligibility(current_state_id)
 
-                # update the value function, eligibilities, and the policy for each state of the current episode
-                self.critic.update_value_function(episode=episode)
-                self.critic.update_eligibilities(episode=episode, discount_rate=self.discount_rate, decay_factor=self.decay_factor)
-                self.actor.update_policy(episode=episode, td_error=td_error)
-                self.actor.update_eligibilities(episode=episode, discount_rate=self.discount_rate, decay_factor=self.decay_factor)
+                # update the value function, eligibilities, and the policy for every state with an
+                # active eligibility trace
+                self.critic.update(trace_decay=trace_decay)
+                self.actor.update(td_error=td_error, trace_decay=trace_decay)
 
                 current_state = successor_state
+                current_state_id = successor_state_id
                 current_action = successor_action
 
             self.epsilon *= self.epsilon_decay
@@ -96,14 +136,58 @@ class ACM:
 
             # update progressbar
 
-            steps_per_episode.append(step)
+            total_steps += step
+            if step < min_steps:
+                min_steps = step
+
+            # formatting and redrawing the description every episode is surprisingly
+            # expensive for short episodes, so only refresh it now and then
+            if episode_count % 20 == 0 or episode_count == self.max_episodes - 1:
+                progress.set_description(
+                    f"[epsilon: {self.epsilon:.3f}] "
+                    f"[steps: (curr:{step} "
+                    f"min:{min_steps} "
+                    f"avg:{total_steps / (episode_count + 1):.3f})] "
+                )
+
+    def _fit_parallel(self, domain: Domain):
+        """
+        Collects episodes in parallel worker processes, A3C style: each worker runs an
+        independent chunk of episodes on a copy of the domain, starting from a snapshot
+        of the policy and value tables, and the updates it accumulated are merged back
+        between rounds. Visualisation episodes are skipped in this mode.
 
-            progress.set_description(
-                f"[epsilon: {self.epsilon:.3f}] "
-                f"[steps: (curr:{steps_per_episode[-1]} "
-                f"min:{min(steps_per_episode)} "
-                f"avg:{np.mean(steps_per_episode):.3f})] "
-            )
+        :param domain: domain object for which the target policy should be learned
+        """
+        progress = tqdm(total=self.max_episodes, desc="Episode", colour="green")
+        remaining = self.max_episodes
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            while remaining > 0:
+                policy_snapshot = self.actor.export_policy()
+                value_snapshot = self.critic.export_values()
+
+                # hand every worker a chunk of episodes together with the snapshots
+                futures = {}
+                chunk = max(1, min(25, remaining // self.workers))
+                for _ in range(self.workers):
+                    if remaining == 0:
+                        break
+                    episodes = min(chunk, remaining)
+                    remaining -= episodes
+                    future = executor.submit(
+                        _collect_episode_updates, self.config, domain, policy_snapshot,
+                        value_snapshot, self.epsilon, episodes, random.randrange(2 ** 32)
+                    )
+                    futures[future] = episodes
+
+                # merge the workers' table updates back into the master tables
+                for future, episodes in futures.items():
+                    policy_table, value_table = future.result()
+                    self.actor.merge_policy(policy_table, policy_snapshot)
+                    self.critic.merge_values(value_table, value_snapshot)
+                    self.epsilon *= self.epsilon_decay ** episodes
+                    progress.update(episodes)
+        progress.close()
 
     def predict(self, domain : Domain):
         # get initial state and action
@@ -124,3 +208,28 @@ class ACM:
 
         # revert epsilon to its original value
         self.actor.epsilon = original_epsilon
+
+
+def _collect_episode_updates(config, domain, policy_table, value_table, epsilon, episodes, seed):
+    """
+    Runs a chunk of episodes on a copy of the domain, starting from the given policy
+    and value snapshots, and returns the resulting tables. Executed in a worker process.
+
+    :param config: the ACM config of the coordinating process
+    :param domain: copy of the domain to collect episodes in
+    :param policy_table: exported policy snapshot to start from
+    :param value_table: exported state-value snapshot to start from
+    :param epsilon: exploration rate at the time the chunk was dispatched
+    :param episodes: number of episodes to run
+    :param seed: seed for the worker's random number generators
+    :return: the worker's exported policy and state-value tables
+    """
+    random.seed(seed)
+    np.random.seed(seed)
+    worker_config = dict(config)
+    worker_config.update(episodes=episodes, epsilon=epsilon, visualise=[], workers=1)
+    acm = ACM(worker_config)
+    acm.actor.load_policy(policy_table)
+    acm.critic.load_values(value_table)
+    acm.fit(domain, show_progress=False)
+    return acm.actor.export_policy(), acm.critic.export_values()
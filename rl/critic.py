@@ -1,84 +1,199 @@
 from abc import ABC, abstractmethod
 import tensorflow as tf
 import numpy as np
-from rl.utils import DefaultValueTable
+
+from rl.utils import apply_td_update
 
 
 class Critic(ABC):
 
+    __slots__ = ()
+
     @abstractmethod
     def reset(self):
         pass
 
     @abstractmethod
-    def increase_eligibility(self, state):
+    def reset_eligibilities(self):
+        pass
+
+    @abstractmethod
+    def add_state(self, state_id):
         pass
 
     @abstractmethod
-    def compute_td_error(self, state, successor_state, reinforcement, discount_rate):
+    def increase_eligibility(self, state_id):
         pass
 
     @abstractmethod
-    def update_value_function(self, episode):
+    def compute_td_error(self, state, successor_state, reinforcement, discount_rate, state_id=None, successor_id=None):
         pass
 
     @abstractmethod
-    def update_eligibilities(self, episode, discount_rate, decay_factor):
+    def update(self, trace_decay):
         pass
 
 
 class TableBasedCritic(Critic):
 
-    def __init__(self, learning_rate):
-        # maps states to values
-        self.state_values = DefaultValueTable(np.random.uniform)
-        self.eligibilities = DefaultValueTable(lambda: 0)
+    __slots__ = (
+        'state_ids', 'state_values', 'eligibilities', 'num_initialised',
+        'active_states', 'num_active', 'learning_rate', 'trace_cutoff', 'td_error'
+    )
+
+    def __init__(self, learning_rate, state_ids=None, trace_cutoff=1e-8):
+        # maps states to integer ids into the value/eligibility buffers; the table
+        # can be shared with the actor so that each state is only interned once
+        self.state_ids = {} if state_ids is None else state_ids
+        self.state_values = np.random.uniform(size=1024)
+        self.eligibilities = np.zeros(1024)
+        # number of leading entries of state_values that belong to an added state
+        self.num_initialised = 0
+        # preallocated buffer holding the ids of the states with a nonzero
+        # eligibility trace, filled up to num_active
+        self.active_states = np.empty(1024, dtype=np.int32)
+        self.num_active = 0
         self.learning_rate = learning_rate
+        # traces that decay below this threshold are zeroed and no longer updated
+        self.trace_cutoff = trace_cutoff
         self.td_error = 0
 
+    def intern_state(self, state):
+        """
+        Interns the given state and returns its integer id
+
+        :param state: state object to intern
+        :return: integer id of the state
+        """
+        state_key = tuple(state)
+        state_id = self.state_ids.get(state_key)
+        if state_id is None:
+            state_id = len(self.state_ids)
+            self.state_ids[state_key] = state_id
+        return state_id
+
+    def add_state(self, state_id):
+        """
+        Ensures the value and eligibility buffers cover the given interned state id.
+        Newly covered states receive a random initial value.
+
+        :param state_id: integer id of an interned state
+        :return: integer id of the state
+        """
+        while state_id >= self.state_values.shape[0]:
+            # the initial values are drawn in batches of the doubling size here,
+            # rather than with a scalar np.random.uniform() call per new state
+            self.state_values = np.concatenate((self.state_values, np.random.uniform(size=self.state_values.shape[0])))
+            self.eligibilities = np.concatenate((self.eligibilities, np.zeros(self.eligibilities.shape[0])))
+        if state_id >= self.num_initialised:
+            self.num_initialised = state_id + 1
+        return state_id
+
     def reset(self):
         """
         Resets all eligibilities to 0
         """
-        for state_id in self.eligibilities.keys():
-            self.eligibilities[state_id] = 0
+        self.reset_eligibilities()
+
+    def reset_eligibilities(self):
+        """
+        Resets all eligibilities to 0. Only the active traces can be nonzero,
+        so zeroing those suffices
+        """
+        if self.num_active == 0:
+            return
+        self.eligibilities[self.active_states[:self.num_active]] = 0
+        self.num_active = 0
 
-    def increase_eligibility(self, state):
-        state_id = hash(tuple(state))
+    def increase_eligibility(self, state_id):
+        """
+        Sets the eligibility of the visited state to 1 following the replacing-trace
+        rule, i.e. the trace is overwritten rather than accumulated on revisits
+        """
+        if self.eligibilities[state_id] == 0:
+            if self.num_active == self.active_states.shape[0]:
+                self.active_states = np.concatenate((self.active_states, np.empty_like(self.active_states)))
+            self.active_states[self.num_active] = state_id
+            self.num_active += 1
         self.eligibilities[state_id] = 1
 
-    def compute_td_error(self, state, successor_state, reinforcement, discount_rate):
+    def compute_td_error(self, state, successor_state, reinforcement, discount_rate, state_id=None, successor_id=None):
         """
         computes the temporal difference error based on the reinforcement and value of a state
+
+        :param state_id: id of an already interned state, interned on the fly when omitted
+        :param successor_id: id of an already interned successor state, interned on the fly when omitted
         :return: td error
         """
-        state_id = hash(tuple(state))
-        suc_state_id = hash(tuple(successor_state))
-        self.td_error = reinforcement + (discount_rate * self.state_values[suc_state_id]) - self.state_values[state_id]
+        if state_id is None:
+            state_id = self.add_state(self.intern_state(state))
+        if successor_id is None:
+            successor_id = self.add_state(self.intern_state(successor_state))
+        self.td_error = reinforcement + (discount_rate * self.state_values[successor_id]) - self.state_values[state_id]
         return self.td_error
 
-    def update_value_function(self, episode):
+    def export_values(self):
+        """
+        Exports the value function as a {state key: value} table, e.g. for handing
+        a snapshot to rollout workers
+
+        :return: dict mapping state keys to their value
+        """
+        return {
+            state_key: self.state_values[state_id]
+            for state_key, state_id in self.state_ids.items()
+            if state_id < self.num_initialised
+        }
+
+    def load_values(self, table):
+        """
+        Overwrites state values with the values of the given table
+
+        :param table: dict mapping state keys to their value
         """
-        Updates the value of the given state based on td_error and the learning_rate
+        for state_key, value in table.items():
+            state_id = self.add_state(self.intern_state(state_key))
+            self.state_values[state_id] = value
+
+    def merge_values(self, table, snapshot):
         """
-        for state, _ in episode:
-            state_id = hash(tuple(state))
-            self.state_values[state_id] += self.learning_rate * self.td_error * self.eligibilities[state_id]
+        Applies the difference between the given value table and the snapshot it was
+        derived from onto the local value function. States first discovered by the
+        worker adopt the worker's value outright
 
-    def update_eligibilities(self, episode, discount_rate, decay_factor):
+        :param table: value table returned by a rollout worker
+        :param snapshot: the value table the worker started from
         """
-        Updates the eligibility traces of the given state using the given discount rate and decay factor
+        for state_key, value in table.items():
+            state_id = self.add_state(self.intern_state(state_key))
+            base = snapshot.get(state_key)
+            if base is None:
+                self.state_values[state_id] = value
+            else:
+                self.state_values[state_id] += value - base
+
+    def update(self, trace_decay):
+        """
+        Updates the values of the states with an active eligibility trace based on
+        td_error and the learning_rate, and decays their traces, in one fused pass.
+        Traces that decay below trace_cutoff are dropped from the active set, so the
+        per-step cost stays bounded regardless of episode length
 
-        :param episode:
-        :param discount_rate: discount rate
-        :param decay_factor: decay factor
+        :param trace_decay: product of the discount rate and the eligibility decay factor
         """
-        for state, _ in episode:
-            state_id = hash(tuple(state))
-            self.eligibilities[state_id] *= discount_rate * decay_factor
+        if self.num_active == 0:
+            return
+        self.num_active = apply_td_update(
+            self.state_values,
+            self.eligibilities,
+            self.active_states[:self.num_active],
+            self.learning_rate * self.td_error,
+            trace_decay,
+            self.trace_cutoff
+        )
 
     def num_seen_states(self):
-        return len(self.state_values)
+        return len(self.state_ids)
 
 
 class NNBasedCritic(Critic):
@@ -104,27 +219,34 @@ class NNBasedCritic(Critic):
 
     def reset(self):
         if len(self.episode) > 0:
-            x = tf.convert_to_tensor(list(map(lambda e: e[0], self.episode)))
+            x = tf.convert_to_tensor(self.episode)
             y = tf.convert_to_tensor(self.targets)
             self.model.fit(x, y, verbose=3)
         self.episode = []
         self.targets = []
 
     # not required
-    def increase_eligibility(self, state):
+    def reset_eligibilities(self):
+        pass
+
+    # state ids are only meaningful for the table-based critic
+    def add_state(self, state_id):
+        return state_id
+
+    # not required
+    def increase_eligibility(self, state_id):
         pass
 
-    def compute_td_error(self, state, successor_state, reinforcement, discount_rate):
+    def compute_td_error(self, state, successor_state, reinforcement, discount_rate, state_id=None, successor_id=None):
         current_state = tf.convert_to_tensor([state])
         successor_state = tf.convert_to_tensor([successor_state])
         v_curr = self.model(current_state)[0, 0]
         v_succ = self.model(successor_state)[0, 0]
+        self.episode.append(state)
         self.targets.append(reinforcement + discount_rate * v_succ)
         return reinforcement + discount_rate * v_succ - v_curr
 
-    def update_value_function(self, episode):
-        self.episode = episode
-
-    # not required
-    def update_eligibilities(self, episode, discount_rate, decay_factor):
+    # not required, the episode is recorded in compute_td_error and
+    # trained on in reset
+    def update(self, trace_decay):
         pass
@@ -1,10 +1,81 @@
-class DefaultValueTable(dict):
+import numpy as np
 
-    def __init__(self, val_func, **kwargs):
-        super().__init__(**kwargs)
-        self.val_func = val_func
+try:
+    from numba import njit
+except ImportError:
+    # numba is optional; without it the kernels below fall back to plain NumPy
+    njit = None
 
-    def __getitem__(self, item):
-        if item not in super().keys():
-            super().__setitem__(item, self.val_func())
-        return super().__getitem__(item)
+
+if njit is not None:
+
+    @njit(cache=True)
+    def apply_td_update(values, eligibilities, ids, coefficient, decay, cutoff):
+        """
+        Applies `values[id] += coefficient * eligibilities[id]` followed by the trace
+        decay `eligibilities[id] *= decay` for every id in a single compiled pass.
+        Traces that decay below the cutoff are zeroed and their ids dropped; the id
+        buffer is compacted in place and the number of surviving ids is returned
+        """
+        num_kept = 0
+        for i in range(ids.shape[0]):
+            state_id = ids[i]
+            values[state_id] += coefficient * eligibilities[state_id]
+            decayed = eligibilities[state_id] * decay
+            if decayed >= cutoff:
+                eligibilities[state_id] = decayed
+                ids[num_kept] = state_id
+                num_kept += 1
+            else:
+                eligibilities[state_id] = 0
+        return num_kept
+
+    @njit(cache=True)
+    def apply_td_update_2d(values, eligibilities, rows, cols, coefficient, decay, cutoff):
+        """
+        Same as apply_td_update for tables indexed by (row, column) id pairs
+        """
+        num_kept = 0
+        for i in range(rows.shape[0]):
+            row = rows[i]
+            col = cols[i]
+            values[row, col] += coefficient * eligibilities[row, col]
+            decayed = eligibilities[row, col] * decay
+            if decayed >= cutoff:
+                eligibilities[row, col] = decayed
+                rows[num_kept] = row
+                cols[num_kept] = col
+                num_kept += 1
+            else:
+                eligibilities[row, col] = 0
+        return num_kept
+
+else:
+
+    def apply_td_update(values, eligibilities, ids, coefficient, decay, cutoff):
+        """
+        Applies `values[id] += coefficient * eligibilities[id]` followed by the trace
+        decay `eligibilities[id] *= decay` for every id. Traces that decay below the
+        cutoff are zeroed and their ids dropped; the id buffer is compacted in place
+        and the number of surviving ids is returned
+        """
+        values[ids] += coefficient * eligibilities[ids]
+        decayed = eligibilities[ids] * decay
+        kept = decayed >= cutoff
+        eligibilities[ids] = np.where(kept, decayed, 0)
+        num_kept = int(np.count_nonzero(kept))
+        ids[:num_kept] = ids[kept]
+        return num_kept
+
+    def apply_td_update_2d(values, eligibilities, rows, cols, coefficient, decay, cutoff):
+        """
+        Same as apply_td_update for tables indexed by (row, column) id pairs
+        """
+        values[rows, cols] += coefficient * eligibilities[rows, cols]
+        decayed = eligibilities[rows, cols] * decay
+        kept = decayed >= cutoff
+        eligibilities[rows, cols] = np.where(kept, decayed, 0)
+        num_kept = int(np.count_nonzero(kept))
+        rows[:num_kept] = rows[kept]
+        cols[:num_kept] = cols[kept]
+        return num_kept
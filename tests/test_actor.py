@@ -0,0 +1,33 @@
+from rl.actor import TableBasedActor
+
+
+def make_worker_table():
+    """
+    Builds the policy table a rollout worker would export after visiting one state
+    """
+    worker = TableBasedActor(learning_rate=0.1, epsilon=0)
+    state_key = (0.0, 1.0)
+    state_id = worker.add_state(worker.intern_state(state_key), ["left", "right"])
+    worker.policy[state_id, worker.action_id("left")] = 0.5
+    return worker.export_policy()
+
+
+def test_export_policy_round_trips_after_merge():
+    # the master only ever sees states through merge_policy, so the merged
+    # entries have to show up in its next exported snapshot
+    table = make_worker_table()
+    assert len(table) == 2
+
+    master = TableBasedActor(learning_rate=0.1, epsilon=0)
+    master.merge_policy(table, {})
+    assert master.export_policy() == table
+
+
+def test_merge_policy_applies_deltas_against_snapshot():
+    table = make_worker_table()
+
+    master = TableBasedActor(learning_rate=0.1, epsilon=0)
+    master.merge_policy(table, {})
+    # merging the unchanged table against the snapshot it came from is a no-op
+    master.merge_policy(table, table)
+    assert master.export_policy() == table